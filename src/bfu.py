@@ -3,20 +3,58 @@
 # Author: Alexander "goodmice" Sirotkin
 # Created Date: 2021-04-29
 # Updated Date: 2021-05-06
+"""
+Upload protocol (after `firmware_update` and UPD_BEG are acknowledged):
+
+Packets are sent in windows of up to `window` packets before any reply is
+read. Every packet is `size (u16 LE) | crc32 (u32 LE) | payload`, and the
+device must answer every packet of a window with a single status byte, in
+order: PKG_ACK if it was accepted, PKG_ERR if it was corrupted or discarded,
+PKG_PAN to abort the update. After the first non-ACK packet of a window the
+device must discard the remaining packets of that window (still answering
+each of them), as the updater resends the window starting from the failed
+packet. With `window` = 1 this is the original stop-and-wait protocol.
+"""
 
 import sys
 import time
 import os.path
 import argparse
-import mimetypes
+from math import ceil
+from stat import S_ISREG
+from mmap import mmap, ACCESS_READ
 from warnings import warn
-from bluetooth import *
-from zlib import crc32
-from struct import pack_into
+from threading import Thread
+from queue import Queue
+from socket import SOL_SOCKET, SO_RCVBUF, SO_SNDBUF, MSG_WAITALL
+from bluetooth import BluetoothSocket, RFCOMM, find_service, discover_devices, lookup_name
+from struct import Struct
+
+from typing import Union, Callable, List, Optional, Iterator, NamedTuple, Tuple
+
+try:
+    # Hardware accelerated CRC-32 (same polynomial as zlib). It is only used
+    # if it gives the known answer for a memoryview, as iter_windows passes.
+    from crc_fast import CrcAlgorithm, checksum
+
+    def crc32(data: memoryview) -> int:
+        return checksum(CrcAlgorithm.Crc32IsoHdlc, data)
+
+    if crc32(memoryview(b'123456789')) != 0xCBF43926:
+        raise ImportError('crc_fast gives a wrong CRC-32')
+    CRC_BACKEND = 'crc_fast'
+except Exception:
+    from zlib import crc32
 
-from typing import Union, Callable, List, Optional
+    CRC_BACKEND = 'zlib'
+
+class Firmware(NamedTuple):
+    path: str
+    size: int
 
 class Context:
+    RENDER_INTERVAL = 0.1
+
     def __init__(self, msg: str = None, **kwargs):
         self.glob: bool = True
         self.msg: str = msg
@@ -26,6 +64,10 @@ class Context:
         self.warn_msg: str = kwargs.pop('warn', 'WARN')
         self.required: bool = kwargs.pop('required', True)
         self.proc = False
+        self.bar: str = ''
+        self.last_render: float = 0.0
+        if not sys.stdout.isatty():  # no progress bar in pipes and logs
+            self.progress = lambda *args, **kwargs: None
 
     def pos(self, proc: bool = True) -> None:
         if self.inline:
@@ -38,7 +80,15 @@ class Context:
             print('\t', end='', flush=True)
 
     def progress(self, cur_v: int, max_v: int, start_time: Optional[float] = None):
-        self.pos(False)
+        now: float = time.monotonic()
+        if cur_v < max_v and now - self.last_render < Context.RENDER_INTERVAL:
+            return
+        self.last_render = now
+        write: Callable = sys.stdout.write
+        if self.inline or self.glob:
+            self.pos(False)
+        else:  # the only thing pos(False) does once the header line is done
+            write('\t')
         size: int = os.get_terminal_size().columns
 
         template: str = '[INFO] Progress: [{0:%d}] {1:3}%%'
@@ -46,9 +96,11 @@ class Context:
             template += ' %3d s' % (time.time() - start_time)
         
         max_c: int = max(size - len(template), 0)
-        sys.stdout.write((template % max_c).format('*'*int(cur_v/max_v*max_c), cur_v*100//max_v))
+        if len(self.bar) != max_c:
+            self.bar = '*'*max_c
+        write((template % max_c).format(self.bar[:cur_v*max_c//max_v], cur_v*100//max_v))
         if cur_v < max_v:
-            sys.stdout.write('\r')
+            write('\r')
             sys.stdout.flush()
         else:
             print()
@@ -102,6 +154,9 @@ class FirmwareUpdater:
 
     PKG_SIZE = 2
     CRC_SIZE = 4
+    HEADER = Struct('<HI')  # PKG_SIZE bytes of size, CRC_SIZE bytes of crc32
+
+    QUEUE_SIZE = 8
 
     def __init__(self, addr: str, path: str, **kwargs):
         self.addr: str = addr
@@ -109,7 +164,15 @@ class FirmwareUpdater:
         self.timeout: int = kwargs.pop('timeout', 1)
         self.packsize: int = kwargs.pop('packsize', 512) - FirmwareUpdater.CRC_SIZE - FirmwareUpdater.PKG_SIZE
         self.attempts: int = kwargs.pop('attempts', 3)
+        self.window: int = kwargs.pop('window', 1)
+        self.recvbuf: int = kwargs.pop('recvbuf', 64*1024)
+        self.sendbuf: int = kwargs.pop('sendbuf', 256*1024)
+        self.prepare_error: Optional[Exception] = None
         self.verbose: int = kwargs.pop('verbose', 0)
+        self.size: int = kwargs.pop('size', None)
+        if self.size is None:
+            self.size = os.path.getsize(self.path)
+        self.npackets: int = ceil(self.size / self.packsize)
 
         with Context('Trying connect to target device'):
             service_matches = find_service(address=addr)
@@ -118,106 +181,182 @@ class FirmwareUpdater:
             first_match = service_matches[0]
             self.sock: BluetoothSocket = BluetoothSocket(RFCOMM)
             self.sock.connect((first_match["host"], first_match["port"]))
+            # Upload is throughput bound: large buffers keep whole windows queued
+            # in the kernel at the cost of latency, which does not matter here
+            self.sock.setsockopt(SOL_SOCKET, SO_SNDBUF, self.sendbuf)
+            self.sock.setsockopt(SOL_SOCKET, SO_RCVBUF, self.recvbuf)
             self.sock.settimeout(self.timeout)
 
-    def prepare_packets(self) -> List[bytes]:
-        result: List[bytes] = []
-        with open(self.path, 'rb') as f:
-            self.full_size = 0
-            size: int = os.path.getsize(self.path)
-            while size > 0:
-                dat_size: int = min(self.packsize, size)
-                dat: bytes = f.read(dat_size)
-                crc: bytes = crc32(dat).to_bytes(4, byteorder='little', signed=False)
-                ds_byte: bytes = dat_size.to_bytes(2, byteorder='little', signed=False)
-
-                result.append(bytes(b''.join([ds_byte, crc, dat])))
-                self.full_size += len(result[-1])
-                size -= dat_size
-        return result
+    def iter_windows(self) -> Iterator[Tuple[bytes, List[int]]]:
+        if self.size == 0:  # empty file can not be mapped
+            return
+        head_size: int = FirmwareUpdater.HEADER.size
+        pack_header: Callable = FirmwareUpdater.HEADER.pack_into
+        buf: bytearray = bytearray(self.window * (head_size + self.packsize))
+        mv: memoryview = memoryview(buf)
+        offsets: List[int] = []
+        pos: int = 0
+        with open(self.path, 'rb') as f, \
+                mmap(f.fileno(), 0, access=ACCESS_READ) as mm, \
+                memoryview(mm) as data:
+            for off in range(0, len(data), self.packsize):
+                with data[off:off + self.packsize] as dat:
+                    n: int = len(dat)
+                    mv[pos + head_size:pos + head_size + n] = dat
+                    pack_header(buf, pos, n, crc32(dat))
+                offsets.append(pos)
+                pos += head_size + n
+                if len(offsets) == self.window:
+                    yield bytes(mv[:pos]), offsets
+                    offsets = []
+                    pos = 0
+        if offsets:
+            yield bytes(mv[:pos]), offsets
+
+    def produce_windows(self, queue: Queue) -> None:
+        try:
+            for w in self.iter_windows():
+                queue.put(w)
+        except Exception as e:
+            self.prepare_error = e
+        finally:
+            queue.put(None)
 
     @staticmethod
-    def list_devices() -> None:
+    def list_devices(duration: int = 8) -> None:
         with Context('Script is looking for devices'):
-            nearby_devices: list = discover_devices(lookup_names = True)
+            nearby_devices: list = discover_devices(duration = duration, lookup_names = True)
         with Context('Found %d devices' % len(nearby_devices)) as c:
             for i, (addr, name) in enumerate(nearby_devices):
                 c.info('Device %d => %s \t %s' % (i, addr, name))
 
-    def send_packet(self, packet: bytes) -> bool:
-        for i in range(self.attempts):
-            self.sock.send(packet)
-            ret = self.sock.recv(1)
-            if ret == FirmwareUpdater.PKG_ACK:
+    def recv_exact(self, size: int) -> bytes:
+        data: bytes = self.sock.recv(size, MSG_WAITALL)
+        while len(data) < size:
+            chunk: bytes = self.sock.recv(size - len(data), MSG_WAITALL)
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def send_window(self, frame: bytes, offsets: List[int]) -> bool:
+        attempt: int = 0
+        start: int = 0
+        while True:
+            self.sock.sendall(frame[offsets[start]:])
+            acks: bytes = self.recv_exact(len(offsets) - start)
+            for i in range(len(offsets) - start):
+                ret: bytes = acks[i:i + 1]
+                if ret != FirmwareUpdater.PKG_ACK:
+                    break
+            else:
                 return True
-            elif ret == FirmwareUpdater.PKG_PAN:
+            if ret == FirmwareUpdater.PKG_PAN:
                 return False
-        self.sock.send(FirmwareUpdater.UPD_ERR)
+            if i > 0:
+                attempt = 0
+            attempt += 1
+            if attempt >= self.attempts:
+                break
+            start += i
+        self.sock.sendall(FirmwareUpdater.UPD_ERR)
         return False
 
     def upload_firmware(self) -> None:
-        with Context('Prepairing packets') as c:
-            self.packets = self.prepare_packets()
+        queue: Queue = Queue(maxsize=FirmwareUpdater.QUEUE_SIZE)
+        Thread(target=self.produce_windows, args=(queue,), daemon=True).start()
         with Context('Starting transaction') as c:
-            self.sock.send(b'firmware_update')
+            self.sock.sendall(b'firmware_update')
             self.sock.recv(1)
-            self.sock.send(FirmwareUpdater.UPD_BEG)
+            self.sock.sendall(FirmwareUpdater.UPD_BEG)
             if self.sock.recv(1) != FirmwareUpdater.PKG_ACK:
                 raise Exception('Transfer did not begin')
         with Context('Sending packets') as c:
+            full_size: int = 0
+            sent: int = 0
+            progress: Callable = c.progress
+            send_window: Callable = self.send_window
             start_time = time.time()
-            for i, p in enumerate(self.packets):
-                c.progress(i + 1, len(self.packets), start_time)
-                if not self.send_packet(p):
-                    raise Exception('packet %d/%d send error' % (i + 1, len(self.packets)))
+            for frame, offsets in iter(queue.get, None):
+                progress(sent + len(offsets), self.npackets, start_time)
+                if not send_window(frame, offsets):
+                    raise Exception('packet %d/%d send error' % (sent + 1, self.npackets))
+                sent += len(offsets)
+                full_size += len(frame)
+            if self.prepare_error is not None:
+                raise self.prepare_error
+            if sent != self.npackets:
+                raise Exception('packet %d/%d prepare error' % (sent + 1, self.npackets))
+            self.full_size = full_size
             self.full_time = time.time() - start_time
             c.info('Full size: %d bytes' % self.full_size)
             c.info('Loading time: %5.2f s' % self.full_time)
             c.info('Average speed: %5.2f KB/s' % (self.full_size / self.full_time / 1024))
+            if self.verbose:
+                c.info('CRC-32 backend: %s' % CRC_BACKEND)
         with Context('Ending transaction') as c:
-            self.sock.send(FirmwareUpdater.UPD_END)
+            self.sock.sendall(FirmwareUpdater.UPD_END)
             if self.sock.recv(1) != FirmwareUpdater.PKG_ACK:
                 raise Exception()
 
 def check_size(parser: argparse.ArgumentParser, size: int) -> bool:
-    if size <= 0:
-        parser.error('Size must be positive!')
+    head_size: int = FirmwareUpdater.PKG_SIZE + FirmwareUpdater.CRC_SIZE
+    if size <= head_size:
+        parser.error('Size must be greater than %d!' % head_size)
     if size > 512:
         parser.error('Size must be no more than 512!')
     return size
 
-def check_file(parser: argparse.ArgumentParser, path: str) -> str:
-    if not os.path.exists(path):
+def check_window(parser: argparse.ArgumentParser, window: int) -> int:
+    if window <= 0:
+        parser.error('Window must be positive!')
+    return window
+
+def check_duration(parser: argparse.ArgumentParser, duration: int) -> int:
+    if duration <= 0:
+        parser.error('Duration must be positive!')
+    return duration
+
+def check_file(parser: argparse.ArgumentParser, path: str) -> Firmware:
+    try:
+        st: os.stat_result = os.stat(path)
+    except FileNotFoundError:
         parser.error('The file %s does not exist!' % path)
-    if not os.path.isfile(path):
+    except OSError as e:
+        parser.error('The file %s is not accessible: %s!' % (path, e.strerror))
+    if not S_ISREG(st.st_mode):
         parser.error('%s is not file!' % path)
-    if mimetypes.guess_type(path)[0] != 'application/octet-stream':
-        parser.error('The file %s of the wrong type!' % path)
-    return path
+    return Firmware(path, st.st_size)
 
 def main() -> None:
     parser: argparse.ArgumentParser = argparse.ArgumentParser(prog='bfu', description='Uploads Firmware to ESP32 on Bluetooth.')
     parser.add_argument('--version', action='version', version='%(prog)s 0.1')
     parser.add_argument('-a', '--attemtps', type=int, default=3, help='number of attempts to resend packet')
     parser.add_argument('-p', '--packsize', type=lambda x: check_size(parser, int(x)), default=512, help='packsize in bytes')
+    parser.add_argument('-w', '--window', type=lambda x: check_window(parser, int(x)), default=1, help='number of packets sent before waiting for acknowledgements')
     parser.add_argument('-v', '--verbose', action='count', default=0, help='verbose output level')
     parser.add_argument('-l', '--list', action='store_true', help='print list of available devices')
     parser.add_argument('-t', '--target', metavar='TARGET', type=str, help='target device UUID')
     parser.add_argument('-n', '--name', metavar='TARGET', type=str, help='target device name')
+    parser.add_argument('-d', '--duration', type=lambda x: check_duration(parser, int(x)), default=8, help='device inquiry duration in 1.28 s units')
     parser.add_argument('path', metavar='PATH', type=lambda x: check_file(parser, x), help='path to firmware binary file', nargs='?')
     args: object = parser.parse_args()
 
     if args.list:
-        FirmwareUpdater.list_devices()
+        FirmwareUpdater.list_devices(args.duration)
         exit(0)
 
+    if args.path is None:
+        parser.error('Path to firmware binary file must be specified!')
+
     if args.target:
         target = args.target
     elif args.name:
         with Context('Finding device with name') as c:
-            nearby_devices: list = discover_devices(lookup_names = True)
-            for addr, name in nearby_devices:
-                if args.name in name:
+            nearby_devices: list = discover_devices(duration = args.duration, lookup_names = False)
+            for addr in nearby_devices:
+                name: Optional[str] = lookup_name(addr, timeout = 2)
+                if name and args.name in name:
                     target = addr
                     break
             else:
@@ -227,7 +366,7 @@ def main() -> None:
         parser.error('Target UUID or name must be specified!')
         parser.exit(1)
 
-    fu = FirmwareUpdater(target, args.path, verbose=args.verbose, packsize=args.packsize)
+    fu = FirmwareUpdater(target, args.path.path, size=args.path.size, verbose=args.verbose, packsize=args.packsize, window=args.window)
     fu.upload_firmware()
 
 if __name__ == '__main__':